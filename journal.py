@@ -1,28 +1,68 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import os
+import argparse
+import cProfile
+import hashlib
+import hmac
+import io
+import json
+import logging
+import mimetypes
+import multiprocessing
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
 from pyramid.config import Configurator
 from pyramid.view import view_config
 from waitress import serve
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import (scoped_session, sessionmaker, relationship,
+                            backref, subqueryload)
 from zope.sqlalchemy import ZopeTransactionExtension
 import transaction
 import datetime
 from pyramid.httpexceptions import (HTTPFound, HTTPForbidden,
                                     HTTPMethodNotAllowed, HTTPNotFound)
-from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.security import remember, forget
+from pyramid.response import FileResponse
+from pyramid.request import Request
+from pyramid.renderers import render
+from pyramid.scripting import prepare
+from pyramid.threadlocal import get_current_request
 from cryptacular.bcrypt import BCRYPTPasswordManager
 from markdown2 import Markdown
+from markupsafe import escape
 
 markdowner = Markdown(extras=["code-friendly", "fenced-code-blocks",
                               "cuddled-lists", "pyshell"])
 
+# Entries with more characters than this render in the render pool rather
+# than on the request thread
+RENDER_POOL_THRESHOLD = int(os.environ.get('RENDER_POOL_THRESHOLD', 20000))
+# Entries with more characters than this are never run through markdown
+RENDER_MAX_SIZE = int(os.environ.get('RENDER_MAX_SIZE', 1000000))
+# Seconds a pooled render may take before plain text is shown instead
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 2))
+RENDER_POOL_SIZE = int(os.environ.get('RENDER_POOL_SIZE', 2))
+
+# Counts of renders that fell back to plain text, keyed by reason
+render_fallbacks = Counter()
+render_log = logging.getLogger('journal.render')
+# One slot per render worker process; a render that can't get a slot is
+# turned away rather than queued
+_render_slots = threading.BoundedSemaphore(RENDER_POOL_SIZE)
+_idle_render_workers = []
+_render_workers_lock = threading.Lock()
+
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 
 
@@ -32,13 +72,42 @@ DATABASE_URL = os.environ.get(
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
+ATTACHMENT_DIR = os.environ.get(
+    'ATTACHMENT_DIR', os.path.join(HERE, 'attachments'))
+# Size of each read/write when streaming an upload to disk
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Attachment files never change once written, so clients may keep them
+ATTACHMENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Uploaded types that are safe to display from our own origin; everything
+# else is sent as a download so a browser never runs it as a page
+ATTACHMENT_INLINE_TYPES = frozenset(
+    ['image/png', 'image/jpeg', 'image/gif', 'image/webp'])
+
+# Entries shown per page on a tag listing
+TAG_PAGE_SIZE = 20
+# Format of the created half of a tag listing's "before" cursor
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 Base = declarative_base()
 
+# Request header that, carrying the profile.secret setting, turns on cProfile
+PROFILE_HEADER = 'X-Profile'
+# Seconds a statement may run before it is written to the slow query log;
+# None leaves the log off. Set through watch_slow_queries.
+SLOW_QUERY_THRESHOLD = None
+
+slow_query_log = logging.getLogger('journal.slow_query')
+
+# Name of the content hash manifest kept in a static export directory
+EXPORT_MANIFEST = 'manifest.json'
+# Set in each export worker by _init_export_worker
+_export_env = {}
+
 
 @view_config(route_name='home', renderer='templates/index.jinja2')
 def list_view(request):
     entries = Entry.all()
-    return {'entries': entries}
+    return {'entries': entries, 'tags': Tag.cloud()}
 
 
 @view_config(route_name='detail', renderer='templates/detail.jinja2')
@@ -59,13 +128,16 @@ def new_entry(request):
         if request.authenticated_userid:
             title = request.params.get('title')
             body_text = request.params.get('body_text')
+            tags = request.params.get('tags', '')
             try:
-                newart = Entry.write(title=title, body_text=body_text)
+                newart = Entry.write(title=title, body_text=body_text,
+                                     tags=split_tags(tags))
                 DBSession.flush()
             except ValueError:
                 return {'err_msg': 'Try Again: need both an entry and a title',
                         'title': title,
-                        'body_text': body_text}
+                        'body_text': body_text,
+                        'tags': tags}
             # TODO: edit points towards the detail page; new view probably
             # should as well. Need to find a way to return the article id.
             return HTTPFound(request.route_url('detail', id=newart.id))
@@ -88,10 +160,13 @@ def edit_entry(request):
         if request.authenticated_userid:
             new_title = request.params.get('title')
             new_body_text = request.params.get('body_text')
+            new_tags = request.params.get('tags')
+            if new_tags is not None:
+                new_tags = split_tags(new_tags)
             article_id = request.matchdict['id']
             try:
                 Entry.edit_entry(title=new_title, body_text=new_body_text,
-                                 id=article_id)
+                                 tags=new_tags, id=article_id)
             except ValueError:
                 # implement something like this, though need to get access to 
                 # article ID on GET
@@ -109,6 +184,92 @@ def edit_entry(request):
         return HTTPMethodNotAllowed()
 
 
+@view_config(route_name='attach')
+def attach_file(request):
+    if request.method != 'POST':
+        return HTTPMethodNotAllowed()
+    if not request.authenticated_userid:
+        return HTTPForbidden()
+    article_id = request.matchdict['id']
+    try:
+        article = Entry.get_article(article_id)
+    except NoResultFound:
+        return HTTPNotFound()
+    upload = request.POST.get('attachment')
+    # An empty file input arrives as a plain string rather than a field
+    if getattr(upload, 'file', None) is not None:
+        try:
+            Attachment.write(entry=article, filename=upload.filename,
+                             fp=upload.file, content_type=upload.type)
+        except ValueError:
+            pass
+    return HTTPFound(request.route_url('detail', id=article_id))
+
+
+@view_config(route_name='attachment')
+def attachment_view(request):
+    try:
+        attachment = Attachment.get_attachment(request.matchdict['id'])
+    except NoResultFound:
+        return HTTPNotFound()
+    # FileResponse hands the open file to wsgi.file_wrapper when it is given
+    # the request. Server wrappers such as waitress's can't seek, so webob
+    # would read a ranged response from byte 0; leave the request out then
+    # and get a FileIter, whose app_iter_range seeks to the start.
+    response = FileResponse(attachment.path,
+                            request=None if request.range else request,
+                            content_type=str(attachment.content_type))
+    response.etag = attachment.digest
+    response.accept_ranges = 'bytes'
+    response.cache_control = ATTACHMENT_CACHE_CONTROL
+    response.headers[str('X-Content-Type-Options')] = str('nosniff')
+    if attachment.content_type in ATTACHMENT_INLINE_TYPES:
+        disposition = b'inline'
+    else:
+        disposition = b'attachment'
+    # Header values must be native strings; drop anything not ASCII
+    safe_name = attachment.filename.encode('ascii', 'ignore')
+    response.content_disposition = (
+        disposition + b'; filename="' + safe_name.replace(b'"', b'') + b'"')
+    return response
+
+
+@view_config(route_name='tag', renderer='templates/tag.jinja2')
+def tag_view(request):
+    name = normalize_tag(request.matchdict['name'])
+    try:
+        before = parse_cursor(request.params.get('before'))
+    except ValueError:
+        return HTTPNotFound()
+    # Ask for one extra row to learn whether there is a next page
+    entries = Entry.by_tag(name, before=before, limit=TAG_PAGE_SIZE + 1)
+    next_cursor = None
+    if len(entries) > TAG_PAGE_SIZE:
+        entries = entries[:TAG_PAGE_SIZE]
+        next_cursor = make_cursor(entries[-1])
+    return {'tag': name, 'entries': entries, 'next_cursor': next_cursor}
+
+
+@view_config(route_name='archive', renderer='templates/archive.jinja2')
+def archive_view(request):
+    months = MonthCount.all()
+    return {'months': months}
+
+
+@view_config(route_name='archive_month',
+             renderer='templates/archive_month.jinja2')
+def archive_month_view(request):
+    try:
+        year = int(request.matchdict['year'])
+        month = int(request.matchdict['month'])
+        entries = Entry.by_month(year, month)
+    except (ValueError, OverflowError):
+        return HTTPNotFound()
+    return {'entries': entries,
+            'month': datetime.date(year, month, 1),
+            'months': MonthCount.all()}
+
+
 @view_config(context=DBAPIError)
 def db_exception(context, request):
     from pyramid.response import Response
@@ -143,6 +304,17 @@ def logout(request):
     return HTTPFound(request.route_url('home'), headers=headers)
 
 
+entry_tags = sa.Table(
+    'entry_tags', Base.metadata,
+    sa.Column('tag_id', sa.Integer, sa.ForeignKey('tags.id'),
+              primary_key=True),
+    sa.Column('entry_id', sa.Integer, sa.ForeignKey('entries.id'),
+              primary_key=True),
+    # The primary key serves tag -> entries; this serves entry -> tags
+    sa.Index('ix_entry_tags_entry_id_tag_id', 'entry_id', 'tag_id'),
+)
+
+
 class Entry(Base):
     __tablename__ = "entries"
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
@@ -150,17 +322,42 @@ class Entry(Base):
     body_text = sa.Column(sa.UnicodeText, nullable=False)
     created = sa.Column(
         sa.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    tags = relationship('Tag', secondary=entry_tags, order_by='Tag.name',
+                        backref='entries')
+
+    __table_args__ = (
+        # Serves the date ordered listings: range scans by month and
+        # keyset pagination, which seeks on (created, id)
+        sa.Index('ix_entries_created_id', 'created', 'id'),
+    )
 
     def render_text(self):
-        return markdowner.convert(self.body_text)
+        return render_markdown(self.body_text, entry_id=self.id)
+
+    def set_tags(self, names, session=None):
+        """Replace this entry's tags, keeping the cached tag counts right"""
+        if session is None:
+            session = DBSession
+        wanted = Tag.from_names(names, session=session)
+        current = list(self.tags)
+        for tag in wanted:
+            if tag not in current:
+                tag.adjust_count(1)
+        for tag in current:
+            if tag not in wanted:
+                tag.adjust_count(-1)
+        self.tags = wanted
 
     @classmethod
-    def write(cls, title=None, body_text=None, session=None, id=None):
+    def write(cls, title=None, body_text=None, tags=None, session=None,
+              id=None):
         if session is None:
             session = DBSession
         if title != "" and body_text != "":
             # Form will pass empty string when empty
             instance = cls(title=title, body_text=body_text)
+            if tags:
+                instance.set_tags(tags, session=session)
             session.add(instance)
             return instance
         else:
@@ -168,7 +365,8 @@ class Entry(Base):
             raise ValueError
 
     @classmethod
-    def edit_entry(cls, title=None, body_text=None, session=None, id=None):
+    def edit_entry(cls, title=None, body_text=None, tags=None, session=None,
+                   id=None):
         if session is None:
             session = DBSession
         edit_article = cls.get_article(article_id=id)
@@ -176,6 +374,9 @@ class Entry(Base):
             # Form will pass empty string when empty
             edit_article.title = title
             edit_article.body_text = body_text
+            if tags is not None:
+                # None leaves the tags alone; an empty list clears them
+                edit_article.set_tags(tags, session=session)
             session.add(edit_article)
             return edit_article
         else:
@@ -194,10 +395,643 @@ class Entry(Base):
             session = DBSession
         return session.query(cls).filter(cls.id == article_id).one()
 
+    @classmethod
+    def by_month(cls, year, month, session=None):
+        """Return entries created in the given month, newest first
+
+        Filters on a half-open range so the lookup is a range scan over
+        the (created, id) index. Raises ValueError for a bad year/month.
+        """
+        if session is None:
+            session = DBSession
+        start = datetime.datetime(year, month, 1)
+        if month == 12:
+            end = datetime.datetime(year + 1, 1, 1)
+        else:
+            end = datetime.datetime(year, month + 1, 1)
+        return session.query(cls).filter(
+            cls.created >= start, cls.created < end
+            ).order_by(cls.created.desc()).all()
+
+    @classmethod
+    def by_tag(cls, name, before=None, limit=TAG_PAGE_SIZE, session=None):
+        """Return up to limit entries tagged name, newest first
+
+        before is a (created, id) pair from the last entry of the previous
+        page; only entries strictly older than it are returned.
+        """
+        if session is None:
+            session = DBSession
+        query = session.query(cls).join(
+            entry_tags, entry_tags.c.entry_id == cls.id
+            ).join(Tag, Tag.id == entry_tags.c.tag_id).filter(Tag.name == name)
+        if before is not None:
+            query = query.filter(
+                sa.tuple_(cls.created, cls.id) < sa.tuple_(*before))
+        return query.order_by(
+            cls.created.desc(), cls.id.desc()).limit(limit).all()
+
+
+class Tag(Base):
+    """A label shared between entries
+
+    count caches how many entries carry the tag, so the tag cloud is a
+    single query over this table.
+    """
+    __tablename__ = "tags"
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    name = sa.Column(sa.Unicode(63), nullable=False, unique=True)
+    count = sa.Column(sa.Integer, nullable=False, default=0)
+
+    def adjust_count(self, amount):
+        if self.id is None:
+            self.count = (self.count or 0) + amount
+        else:
+            # Let the database do the arithmetic so concurrent writers
+            # don't overwrite each other's counts
+            self.count = Tag.count + amount
+
+    @classmethod
+    def from_names(cls, names, session=None):
+        """Return Tags for names in order, creating any that are missing"""
+        if session is None:
+            session = DBSession
+        names = [name for name in (normalize_tag(n) for n in names) if name]
+        names = sorted(set(names), key=names.index)
+        if not names:
+            return []
+        existing = dict((tag.name, tag) for tag in
+                        session.query(cls).filter(cls.name.in_(names)))
+        tags = []
+        for name in names:
+            tag = existing.get(name)
+            if tag is None:
+                tag = cls(name=name, count=0)
+                session.add(tag)
+            tags.append(tag)
+        return tags
+
+    @classmethod
+    def cloud(cls, session=None):
+        if session is None:
+            session = DBSession
+        return session.query(cls).filter(cls.count > 0).order_by(
+            cls.name).all()
+
+
+def render_markdown(text, entry_id=None):
+    """Convert text to html, keeping large entries off the request thread
+
+    Text over RENDER_POOL_THRESHOLD is converted in one of RENDER_POOL_SIZE
+    worker processes so it neither holds the GIL nor runs past
+    RENDER_TIMEOUT. Text that is too big, finds every worker busy, or times
+    out is shown as escaped plain text instead.
+    """
+    if len(text) > RENDER_MAX_SIZE:
+        return _render_fallback(text, 'oversize', entry_id)
+    # Daemonic processes, such as export workers, can't start children
+    if (len(text) <= RENDER_POOL_THRESHOLD or
+            multiprocessing.current_process().daemon):
+        return markdowner.convert(text)
+    if not _render_slots.acquire(False):
+        return _render_fallback(text, 'busy', entry_id)
+    try:
+        with _render_workers_lock:
+            if _idle_render_workers:
+                worker = _idle_render_workers.pop()
+            else:
+                worker = None
+        if worker is None:
+            worker = _RenderWorker()
+        try:
+            html = worker.render(text, RENDER_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            # Only this worker is stuck; the others keep rendering
+            worker.stop()
+            return _render_fallback(text, 'timeout', entry_id)
+        except (EOFError, IOError, OSError):
+            # The worker died, either before we wrote to it or mid-render
+            worker.stop()
+            return _render_fallback(text, 'error', entry_id)
+        with _render_workers_lock:
+            _idle_render_workers.append(worker)
+        if html is None:
+            return _render_fallback(text, 'error', entry_id)
+        return html
+    finally:
+        _render_slots.release()
+
+
+class _RenderWorker(object):
+    """A process converting markdown sent to it over a pipe
+
+    A worker is only handed text while idle, so the timeout given to
+    render covers the conversion alone.
+    """
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_render_worker_loop, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def render(self, text, timeout):
+        """Return html, or None if markdown raised
+
+        Raises multiprocessing.TimeoutError if no answer comes in time. If
+        the process has died, raises IOError or OSError when sending, or
+        EOFError when receiving.
+        """
+        self.conn.send(text)
+        if not self.conn.poll(timeout):
+            raise multiprocessing.TimeoutError
+        return self.conn.recv()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+def _render_worker_loop(conn):
+    while True:
+        try:
+            text = conn.recv()
+        except EOFError:
+            return
+        try:
+            html = markdowner.convert(text)
+        except Exception:
+            html = None
+        conn.send(html)
+
+
+def _render_fallback(text, reason, entry_id):
+    render_fallbacks[reason] += 1
+    # The running total makes the counter readable from the log alone
+    render_log.warning('markdown render fell back to plain text: '
+                       'reason=%s entry=%s size=%d total=%d', reason,
+                       entry_id, len(text), render_fallbacks[reason])
+    return '<pre class="render-fallback">{}</pre>'.format(escape(text))
+
+
+def normalize_tag(name):
+    # '/' would split the name across segments of the /tag/{name} route
+    name = name.replace('/', '-')
+    return ' '.join(name.lower().split())[:63]
+
+
+def split_tags(text):
+    """Split a comma separated form field into tag names"""
+    return [name for name in (text or '').split(',') if name.strip()]
+
+
+def make_cursor(entry):
+    return '{}_{}'.format(entry.created.strftime(CURSOR_DATE_FORMAT),
+                          entry.id)
+
+
+def parse_cursor(cursor):
+    """Turn a make_cursor string back into (created, id); ValueError if bad"""
+    if not cursor:
+        return None
+    created, _, entry_id = cursor.rpartition('_')
+    return (datetime.datetime.strptime(created, CURSOR_DATE_FORMAT),
+            int(entry_id))
+
+
+class MonthCount(Base):
+    """Number of entries per calendar month, for the archive listing
+
+    Kept up to date as entries are inserted so the archive never has to
+    GROUP BY over the entries table.
+    """
+    __tablename__ = "month_counts"
+    year = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    month = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    count = sa.Column(sa.Integer, nullable=False, default=0)
+
+    @property
+    def date(self):
+        return datetime.date(self.year, self.month, 1)
+
+    @classmethod
+    def all(cls, session=None):
+        if session is None:
+            session = DBSession
+        return session.query(cls).filter(cls.count > 0).order_by(
+            cls.year.desc(), cls.month.desc()).all()
+
+    @classmethod
+    def increment(cls, created, connection, amount=1):
+        """Add amount to the bucket for created's month, creating it"""
+        table = cls.__table__
+        match = sa.and_(table.c.year == created.year,
+                        table.c.month == created.month)
+        update = table.update().where(match).values(
+            count=table.c.count + amount)
+        if connection.execute(update).rowcount:
+            return
+        # A concurrent writer may create the bucket between our UPDATE and
+        # INSERT; the savepoint lets us fall back to updating its row
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(table.insert().values(
+                year=created.year, month=created.month, count=amount))
+        except IntegrityError:
+            savepoint.rollback()
+            connection.execute(update)
+        else:
+            savepoint.commit()
+
+    @classmethod
+    def rebuild(cls, connection):
+        """Recompute every bucket from the entries table"""
+        table = cls.__table__
+        year = sa.extract('year', Entry.created)
+        month = sa.extract('month', Entry.created)
+        rows = connection.execute(
+            sa.select([year, month, sa.func.count(Entry.id)])
+            .group_by(year, month))
+        connection.execute(table.delete())
+        for row_year, row_month, count in rows:
+            connection.execute(table.insert().values(
+                year=int(row_year), month=int(row_month), count=count))
+
+
+class Attachment(Base):
+    """A file uploaded against an entry
+
+    The bytes live on disk under ATTACHMENT_DIR, named by their sha256
+    digest, so identical uploads share one file.
+    """
+    __tablename__ = "attachments"
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    entry_id = sa.Column(sa.Integer, sa.ForeignKey('entries.id'),
+                         nullable=False, index=True)
+    filename = sa.Column(sa.Unicode(255), nullable=False)
+    content_type = sa.Column(sa.Unicode(127), nullable=False)
+    digest = sa.Column(sa.String(64), nullable=False, index=True)
+    size = sa.Column(sa.BigInteger, nullable=False)
+    created = sa.Column(
+        sa.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    entry = relationship(
+        Entry, backref=backref('attachments', order_by=id))
+
+    @property
+    def path(self):
+        return attachment_path(self.digest)
+
+    @classmethod
+    def write(cls, entry=None, filename=None, fp=None, content_type=None,
+              session=None):
+        if session is None:
+            session = DBSession
+        filename = os.path.basename(filename or '')
+        if not filename or fp is None:
+            raise ValueError
+        if not content_type or content_type == 'application/octet-stream':
+            content_type = (mimetypes.guess_type(filename)[0] or
+                            'application/octet-stream')
+        digest, size = store_upload(fp)
+        instance = cls(entry=entry, filename=filename[-255:],
+                       content_type=content_type, digest=digest, size=size)
+        session.add(instance)
+        return instance
+
+    @classmethod
+    def get_attachment(cls, attachment_id, session=None):
+        if session is None:
+            session = DBSession
+        return session.query(cls).filter(cls.id == attachment_id).one()
+
+
+def attachment_path(digest):
+    return os.path.join(ATTACHMENT_DIR, digest[:2], digest)
+
+
+def store_upload(fp):
+    """Stream fp to its content-addressed path; return (digest, size)
+
+    The file is copied in ATTACHMENT_CHUNK_SIZE pieces to a temporary file
+    beside the store, then renamed into place once its digest is known.
+    """
+    if not os.path.isdir(ATTACHMENT_DIR):
+        os.makedirs(ATTACHMENT_DIR)
+    sha = hashlib.sha256()
+    size = 0
+    handle, tmp_path = tempfile.mkstemp(dir=ATTACHMENT_DIR)
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            while True:
+                chunk = fp.read(ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = sha.hexdigest()
+        final_path = attachment_path(digest)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+        else:
+            if not os.path.isdir(os.path.dirname(final_path)):
+                os.makedirs(os.path.dirname(final_path))
+            os.rename(tmp_path, final_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest, size
+
+
+@sa.event.listens_for(Entry, 'after_insert')
+def _count_new_entry(mapper, connection, target):
+    # Runs inside the flush, after the created default has been filled in,
+    # so the bucket always matches the stored timestamp.
+    MonthCount.increment(target.created, connection)
+
+
+@sa.event.listens_for(Entry, 'after_update')
+def _recount_moved_entry(mapper, connection, target):
+    history = sa.inspect(target).attrs.created.history
+    if history.deleted and history.added:
+        MonthCount.increment(history.deleted[0], connection, amount=-1)
+        MonthCount.increment(history.added[0], connection)
+
+
+@sa.event.listens_for(Entry, 'after_delete')
+def _uncount_entry(mapper, connection, target):
+    MonthCount.increment(target.created, connection, amount=-1)
+
 
 def init_db():
     engine = sa.create_engine(DATABASE_URL, echo=False)
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        # Seed the archive buckets for entries written before they existed
+        MonthCount.rebuild(connection)
+
+
+def profiling_tween_factory(handler, registry):
+    """Run chosen requests under cProfile and dump stats to profile.dir
+
+    A request is profiled if it sends PROFILE_HEADER equal to the
+    profile.secret setting, or is picked at random at profile.sample_rate.
+    Without a profile.dir the tween steps aside entirely.
+    """
+    settings = registry.settings
+    profile_dir = settings.get('profile.dir')
+    if not profile_dir:
+        return handler
+    secret = settings.get('profile.secret', '')
+    sample_rate = float(settings.get('profile.sample_rate') or 0)
+
+    def profiling_tween(request):
+        token = request.headers.get(PROFILE_HEADER, '')
+        if not ((secret and hmac.compare_digest(str(token), str(secret))) or
+                random.random() < sample_rate):
+            return handler(request)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(handler, request)
+        finally:
+            write_profile(profiler, request, profile_dir)
+
+    return profiling_tween
+
+
+def write_profile(profiler, request, profile_dir):
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    matched = getattr(request, 'matched_route', None)
+    route = matched.name if matched is not None else 'none'
+    filename = '{:.6f}-{}-{}.prof'.format(time.time(), route, os.getpid())
+    profiler.dump_stats(os.path.join(profile_dir, filename))
+
+
+def watch_slow_queries(threshold, log_path=None):
+    """Log statements slower than threshold seconds, with their plans"""
+    global SLOW_QUERY_THRESHOLD
+    SLOW_QUERY_THRESHOLD = threshold
+    if log_path:
+        # FileHandler stores the absolute path; compare like with like
+        log_path = os.path.abspath(log_path)
+    if log_path and not any(getattr(h, 'baseFilename', None) == log_path
+                            for h in slow_query_log.handlers):
+        slow_query_log.addHandler(logging.FileHandler(log_path))
+    ensure_log_handler(slow_query_log)
+    if not sa.event.contains(sa.engine.Engine, 'before_cursor_execute',
+                             _start_query_timer):
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute',
+                        _start_query_timer)
+        sa.event.listen(sa.engine.Engine, 'after_cursor_execute',
+                        _check_query_time)
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context,
+                       executemany):
+    if SLOW_QUERY_THRESHOLD is not None:
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+def _check_query_time(conn, cursor, statement, parameters, context,
+                      executemany):
+    if SLOW_QUERY_THRESHOLD is None or not conn.info.get('query_start_time'):
+        return
+    elapsed = time.time() - conn.info['query_start_time'].pop()
+    if elapsed < SLOW_QUERY_THRESHOLD:
+        return
+    request = get_current_request()
+    matched = getattr(request, 'matched_route', None)
+    if matched is not None:
+        route = matched.name
+    elif request is not None:
+        route = request.path
+    else:
+        route = None
+    plan = None
+    if not executemany:
+        plan = explain(cursor, statement, parameters)
+    slow_query_log.warning(
+        'slow query: %.3fs route=%s\n%s\nparameters: %r\nplan:\n%s',
+        elapsed, route, statement, parameters, plan)
+
+
+def explain(cursor, statement, parameters):
+    """Return the EXPLAIN output for statement, or None if unavailable
+
+    Runs inside a savepoint so a failed EXPLAIN can't abort the
+    surrounding transaction.
+    """
+    verb = statement.lstrip().split(None, 1)[0].upper()
+    if verb not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+        return None
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            explain_cursor.execute('EXPLAIN ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+        except Exception:
+            explain_cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return None
+        explain_cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return plan
+    finally:
+        explain_cursor.close()
+
+
+def export_site(directory, processes=None, database_url=None):
+    """Write the journal to directory as static html
+
+    The home page goes to index.html, each entry to detail/<id>/index.html
+    and the static assets to static/. A manifest of content hashes from the
+    previous run means only entries that changed are rendered again; any
+    change to the templates renders everything. Entries are rendered across
+    a pool of processes, or in this one when processes is 0; pool workers
+    read from database_url, DATABASE_URL by default. Returns the ids of
+    the entries that were rendered.
+    """
+    app = main()
+    manifest_path = os.path.join(directory, EXPORT_MANIFEST)
+    try:
+        with io.open(manifest_path, encoding='utf-8') as manifest_file:
+            previous = json.load(manifest_file)
+    except (IOError, ValueError):
+        previous = {}
+    manifest = {'templates': hash_tree(os.path.join(HERE, 'templates'))}
+    if previous.get('templates') != manifest['templates']:
+        previous = {}
+
+    entries = DBSession.query(Entry).options(
+        subqueryload('tags'), subqueryload('attachments')
+        ).order_by(Entry.created.desc()).all()
+    tags = Tag.cloud()
+    manifest['entries'] = dict(
+        (str(entry.id), entry_digest(entry)) for entry in entries)
+    manifest['index'] = _digest([
+        [[entry.id, entry.title, entry.created.isoformat()]
+         for entry in entries],
+        [[tag.name, tag.count] for tag in tags]])
+    old_entries = previous.get('entries', {})
+    stale = [int(entry_id) for entry_id, digest in
+             manifest['entries'].items() if old_entries.get(entry_id) != digest]
+    if previous.get('index') != manifest['index']:
+        write_page(os.path.join(directory, 'index.html'), render_page(
+            app, 'templates/index.jinja2', {'entries': entries, 'tags': tags}
+            ).encode('utf-8'))
+    for entry_id in set(old_entries) - set(manifest['entries']):
+        shutil.rmtree(os.path.join(directory, 'detail', entry_id),
+                      ignore_errors=True)
+
+    if processes == 0:
+        _export_env.update(app=app, directory=directory)
+        for entry_id in stale:
+            _export_entry(entry_id)
+    elif stale:
+        # Workers open their own connections; don't hand them ours. A
+        # session bound to a Connection belongs to the caller, so leave it.
+        bind = DBSession.bind
+        DBSession.remove()
+        if isinstance(bind, sa.engine.Engine):
+            bind.dispose()
+        pool = multiprocessing.Pool(
+            processes, initializer=_init_export_worker,
+            initargs=(directory, database_url or DATABASE_URL))
+        try:
+            pool.map(_export_entry, stale)
+        finally:
+            pool.close()
+            pool.join()
+
+    manifest['static'] = copy_static(os.path.join(directory, 'static'),
+                                     previous.get('static', {}))
+    write_page(manifest_path, json.dumps(
+        manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return stale
+
+
+def _init_export_worker(directory, database_url):
+    DBSession.remove()
+    _export_env.update(app=main(), directory=directory)
+    # main() skips connecting under TESTING; workers always need a database
+    DBSession.configure(bind=sa.create_engine(database_url))
+
+
+def _export_entry(entry_id):
+    article = Entry.get_article(entry_id)
+    html = render_page(_export_env['app'], 'templates/detail.jinja2',
+                       {'article': article})
+    write_page(os.path.join(_export_env['directory'], 'detail',
+                            str(entry_id), 'index.html'), html.encode('utf-8'))
+
+
+def render_page(app, template, value):
+    """Render template as an anonymous GET of the site root would
+
+    The templates only link by route_path, so the pages work wherever the
+    export is served from the root of a host.
+    """
+    request = Request.blank('/')
+    env = prepare(request=request, registry=app.registry)
+    try:
+        return render(template, value, request=request)
+    finally:
+        env['closer']()
+
+
+def write_page(path, data):
+    """Write data to path by rename, so readers never see half a file"""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as out:
+        out.write(data)
+    # mkstemp makes the file private; the mirror has to be world readable
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+
+def copy_static(target, previous):
+    """Copy changed static assets to target; return their new hashes"""
+    source = os.path.join(HERE, 'static')
+    hashes = {}
+    for name in sorted(os.listdir(source)):
+        with open(os.path.join(source, name), 'rb') as asset:
+            hashes[name] = hashlib.sha256(asset.read()).hexdigest()
+        destination = os.path.join(target, name)
+        if previous.get(name) != hashes[name] or \
+                not os.path.exists(destination):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            shutil.copyfile(os.path.join(source, name), destination)
+    return hashes
+
+
+def hash_tree(path):
+    sha = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        sha.update(name.encode('utf-8'))
+        with open(os.path.join(path, name), 'rb') as member:
+            sha.update(member.read())
+    return sha.hexdigest()
+
+
+def entry_digest(entry):
+    """Hash everything about entry that shows on its detail page"""
+    return _digest([
+        entry.title, entry.body_text, entry.created.isoformat(),
+        [tag.name for tag in entry.tags],
+        [[attachment.id, attachment.filename, attachment.size]
+         for attachment in entry.attachments]])
+
+
+def _digest(value):
+    text = json.dumps(value, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
 
 def do_login(request):
@@ -214,8 +1048,21 @@ def do_login(request):
     return False
 
 
+def ensure_log_handler(logger):
+    """Make sure logger's warnings are written somewhere
+
+    The app doesn't configure logging, and on python 2 a logger with no
+    handler anywhere drops its records. Falls back to stderr.
+    """
+    if not logger.handlers and not logging.getLogger().handlers:
+        logger.addHandler(logging.StreamHandler())
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.WARNING)
+
+
 def main():
     """Create a configured wsgi app"""
+    ensure_log_handler(render_log)
     settings = {}
     debug = os.environ.get('DEBUG', True)
     settings['reload_all'] = debug
@@ -225,6 +1072,13 @@ def main():
     settings['auth.password'] = os.environ.get(
         'AUTH_PASSWORD', manager.encode('secret')
         )
+    settings['profile.dir'] = os.environ.get('PROFILE_DIR', '')
+    settings['profile.secret'] = os.environ.get('PROFILE_SECRET', '')
+    settings['profile.sample_rate'] = os.environ.get('PROFILE_SAMPLE_RATE', 0)
+    slow_query_threshold = os.environ.get('SLOW_QUERY_THRESHOLD')
+    if slow_query_threshold:
+        watch_slow_queries(float(slow_query_threshold),
+                           log_path=os.environ.get('SLOW_QUERY_LOG'))
     if not os.environ.get('TESTING', False):
         #  Connect to database only if not in testing
         engine = sa.create_engine(DATABASE_URL)
@@ -244,19 +1098,41 @@ def main():
     # Allow packages to declare their configurations
     config.include('pyramid_tm')
     config.include('pyramid_jinja2')
+    config.add_tween('journal.profiling_tween_factory')
     config.add_route('home', '/')
     config.add_route('login', '/login')
     config.add_route('logout', '/logout')
     config.add_route('detail', '/detail/{id}')
     config.add_route('new', '/new')
     config.add_route('edit', '/edit/{id}')
+    config.add_route('attach', '/detail/{id}/attach')
+    config.add_route('attachment', '/attachment/{id}')
+    config.add_route('tag', '/tag/{name}')
+    config.add_route('archive', '/archive')
+    config.add_route('archive_month', '/archive/{year}/{month}')
     config.add_static_view('static', os.path.join(HERE, 'static'))
     config.scan()
     app = config.make_wsgi_app()
     return app
 
 
+def export_command(argv):
+    parser = argparse.ArgumentParser(
+        prog='journal.py export',
+        description='Write the journal out as static files.')
+    parser.add_argument('directory')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='render workers; 0 renders in this process')
+    args = parser.parse_args(argv)
+    rendered = export_site(args.directory, processes=args.processes)
+    print('rendered {} entries'.format(len(rendered)))
+
+
 if __name__ == '__main__':
-    app = main()
-    port = os.environ.get('PORT', 5000)
-    serve(app, host='0.0.0.0', port=port)
+    import sys
+    if sys.argv[1:2] == ['export']:
+        export_command(sys.argv[2:])
+    else:
+        app = main()
+        port = os.environ.get('PORT', 5000)
+        serve(app, host='0.0.0.0', port=port)
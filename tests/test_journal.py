@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import os
+import datetime
 import pytest
+import sqlalchemy as sa
 from sqlalchemy.exc import IntegrityError
 import journal
 
@@ -297,3 +299,397 @@ def test_code_color(app, db_session):
     assert '<span class="kn">' in detail.body
     assert '<span class="p">' in detail.body
     assert '<span class="nf">' in detail.body
+
+
+def test_month_count_tracks_writes(db_session):
+    for x in range(2):
+        journal.Entry.write(title="Title {}".format(x),
+                            body_text="Entry Text {}".format(x),
+                            session=db_session)
+    db_session.flush()
+    months = journal.MonthCount.all()
+    assert len(months) == 1
+    assert months[0].count == 2
+
+
+def test_by_month(db_session):
+    in_month = journal.Entry(title="In", body_text="In month",
+                             created=datetime.datetime(2015, 7, 31, 23, 59))
+    after = journal.Entry(title="After", body_text="Next month",
+                          created=datetime.datetime(2015, 8, 1))
+    db_session.add_all([in_month, after])
+    db_session.flush()
+    entries = journal.Entry.by_month(2015, 7)
+    assert [e.title for e in entries] == ["In"]
+    with pytest.raises(ValueError):
+        journal.Entry.by_month(2015, 13)
+
+
+def test_archive_listing(app, entry):
+    response = app.get('/archive')
+    assert response.status_code == 200
+    label = entry.created.strftime('%B %Y')
+    assert '{} (1)'.format(label) in response.body
+    month = app.get('/archive/{}/{}'.format(entry.created.year,
+                                            entry.created.month))
+    assert entry.title in month.body
+
+
+def test_archive_bad_month(app):
+    app.get('/archive/2015/13', status=404)
+
+
+@pytest.fixture()
+def attachment_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(journal, 'ATTACHMENT_DIR', str(tmpdir))
+    return tmpdir
+
+
+def test_store_upload_content_addressed(attachment_dir):
+    from io import BytesIO
+    data = b'x' * (journal.ATTACHMENT_CHUNK_SIZE * 2 + 1)
+    digest, size = journal.store_upload(BytesIO(data))
+    assert size == len(data)
+    with open(journal.attachment_path(digest), 'rb') as stored:
+        assert stored.read() == data
+    # Identical content maps onto the same file
+    assert journal.store_upload(BytesIO(data)) == (digest, size)
+    assert len(attachment_dir.join(digest[:2]).listdir()) == 1
+
+
+def test_upload_and_download_attachment(app, entry, attachment_dir):
+    login_helper('admin', 'secret', app)
+    app.post('/detail/{}/attach'.format(entry.id),
+             upload_files=[('attachment', 'notes.txt', b'0123456789')],
+             status='3*')
+    # The request's commit closed the fixture session; don't touch entry
+    attachment = journal.DBSession.query(journal.Attachment).one()
+    assert attachment.filename == 'notes.txt'
+    assert attachment.content_type == 'text/plain'
+    url = '/attachment/{}'.format(attachment.id)
+    assert url in app.get('/detail/{}'.format(entry.id)).body
+    response = app.get(url)
+    assert response.body == b'0123456789'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert response.headers['Content-Disposition'].startswith('attachment')
+    ranged = app.get(url, headers={'Range': 'bytes=2-4'}, status=206)
+    assert ranged.body == b'234'
+    app.get(url, headers={'If-None-Match': '"{}"'.format(attachment.digest)},
+            status=304)
+
+
+class RecordingFileWrapper(object):
+    """A wsgi.file_wrapper that, like waitress's, can't serve a range"""
+    used = 0
+
+    def __init__(self, fp, block_size=8192):
+        RecordingFileWrapper.used += 1
+        self.fp = fp
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.fp.read(self.block_size), b'')
+
+    def close(self):
+        self.fp.close()
+
+
+def test_attachment_range_skips_file_wrapper(app, entry, attachment_dir,
+                                             monkeypatch):
+    from io import BytesIO
+    monkeypatch.setattr(RecordingFileWrapper, 'used', 0)
+    attachment = journal.Attachment.write(
+        entry=entry, filename='data.bin', fp=BytesIO(b'0123456789'))
+    journal.DBSession.flush()
+    url = '/attachment/{}'.format(attachment.id)
+    environ = {str('wsgi.file_wrapper'): RecordingFileWrapper}
+    response = app.get(url, extra_environ=environ)
+    assert response.body == b'0123456789'
+    assert RecordingFileWrapper.used == 1
+    ranged = app.get(url, headers={str('Range'): str('bytes=7-8')},
+                     extra_environ=environ, status=206)
+    assert ranged.body == b'78'
+    assert RecordingFileWrapper.used == 1
+
+
+def test_html_attachment_not_inline(app, entry, attachment_dir):
+    login_helper('admin', 'secret', app)
+    app.post('/detail/{}/attach'.format(entry.id),
+             upload_files=[('attachment', 'evil.html', b'<script></script>')],
+             status='3*')
+    attachment = journal.DBSession.query(journal.Attachment).one()
+    response = app.get('/attachment/{}'.format(attachment.id))
+    assert response.headers['Content-Disposition'].startswith('attachment')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+
+def test_upload_attachment_not_authorized(app, entry, attachment_dir):
+    app.post('/detail/{}/attach'.format(entry.id),
+             upload_files=[('attachment', 'notes.txt', b'data')],
+             status=403)
+
+
+def test_write_entry_with_tags(db_session):
+    entry = journal.Entry.write(title="Tagged", body_text="Text",
+                                tags=['Decorators', 'sqlalchemy', ' '],
+                                session=db_session)
+    db_session.flush()
+    assert [tag.name for tag in entry.tags] == ['decorators', 'sqlalchemy']
+    cloud = journal.Tag.cloud()
+    assert [(tag.name, tag.count) for tag in cloud] == [
+        ('decorators', 1), ('sqlalchemy', 1)]
+
+
+def test_edit_entry_tags_updates_counts(db_session, entry):
+    journal.Entry.edit_entry(title=entry.title, body_text=entry.body_text,
+                             tags=['decorators'], id=entry.id)
+    db_session.flush()
+    journal.Entry.edit_entry(title=entry.title, body_text=entry.body_text,
+                             tags=['sqlalchemy'], id=entry.id)
+    db_session.flush()
+    assert [(tag.name, tag.count) for tag in journal.Tag.cloud()] == [
+        ('sqlalchemy', 1)]
+
+
+def test_tag_listing_paginates(app, db_session, monkeypatch):
+    monkeypatch.setattr(journal, 'TAG_PAGE_SIZE', 2)
+    for x in range(3):
+        journal.Entry.write(
+            title="Title {}".format(x), body_text="Text",
+            tags=['decorators'], session=db_session)
+        db_session.flush()
+    first = app.get('/tag/decorators')
+    assert 'Title 2' in first.body and 'Title 1' in first.body
+    assert 'Title 0' not in first.body
+    second = first.click('Older entries')
+    assert 'Title 0' in second.body
+    assert 'Older entries' not in second.body
+
+
+def test_tag_listing_bad_cursor(app):
+    app.get('/tag/decorators?before=nonsense', status=404)
+
+
+def test_post_with_tags(app):
+    login_helper('admin', 'secret', app)
+    entry_data = {'title': 'Hello there', 'body_text': 'This is a post',
+                  'tags': 'decorators, sqlalchemy'}
+    detail = app.post('/new', params=entry_data, status='3*').follow()
+    assert 'href="/tag/decorators"' in detail.body
+    home = app.get('/')
+    assert 'sqlalchemy (1)' in home.body
+
+
+def test_profile_header(db_session, tmpdir, monkeypatch):
+    import pstats
+    from webtest import TestApp
+    # WebTest's lint wants native strings on py2, not unicode_literals
+    monkeypatch.setenv(str('PROFILE_DIR'), str(tmpdir))
+    monkeypatch.setenv(str('PROFILE_SECRET'), str('let-me-see'))
+    app = TestApp(journal.main())
+    app.get('/')
+    assert tmpdir.listdir() == []
+    app.get('/', headers={str(journal.PROFILE_HEADER): str('wrong')})
+    assert tmpdir.listdir() == []
+    app.get('/', headers={str(journal.PROFILE_HEADER): str('let-me-see')})
+    profiles = tmpdir.listdir()
+    assert len(profiles) == 1
+    assert '-home-' in profiles[0].basename
+    assert pstats.Stats(str(profiles[0])).total_calls > 0
+
+
+def test_slow_query_log(app, monkeypatch):
+    import logging
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record.getMessage())
+
+    handler = ListHandler()
+    journal.slow_query_log.addHandler(handler)
+    monkeypatch.setattr(journal, 'SLOW_QUERY_THRESHOLD', None)
+    try:
+        journal.watch_slow_queries(0)
+        app.get('/')
+    finally:
+        journal.slow_query_log.removeHandler(handler)
+    logged = [msg for msg in handler.records if 'FROM entries' in msg]
+    assert logged
+    assert 'route=home' in logged[0]
+    assert 'Scan' in logged[0]
+
+
+def test_export_site_incremental(app, db_session, tmpdir):
+    first = journal.Entry.write(title="First", body_text="One",
+                                session=db_session)
+    second = journal.Entry.write(title="Second", body_text="Two",
+                                 session=db_session)
+    db_session.flush()
+    rendered = journal.export_site(str(tmpdir), processes=0)
+    assert sorted(rendered) == sorted([first.id, second.id])
+    assert 'Second' in tmpdir.join('index.html').read()
+    detail = tmpdir.join('detail', str(first.id), 'index.html')
+    assert 'One' in detail.read()
+    # Links must work on the mirror, not point back at a hard coded host
+    assert 'http://localhost' not in detail.read()
+    assert 'href="/archive"' in detail.read()
+    assert tmpdir.join('static', 'style.css').check()
+    assert tmpdir.join(journal.EXPORT_MANIFEST).check()
+
+    assert journal.export_site(str(tmpdir), processes=0) == []
+
+    journal.Entry.edit_entry(title="First", body_text="One, edited",
+                             id=first.id)
+    db_session.flush()
+    assert journal.export_site(str(tmpdir), processes=0) == [first.id]
+    assert 'One, edited' in detail.read()
+
+
+def test_render_large_entry_in_pool(monkeypatch):
+    monkeypatch.setattr(journal, 'RENDER_POOL_THRESHOLD', 0)
+    monkeypatch.setattr(journal, 'RENDER_TIMEOUT', 30)
+    html = journal.render_markdown('# A large title')
+    assert '<h1>A large title</h1>' in html
+
+
+def test_render_timeout_falls_back(monkeypatch):
+    monkeypatch.setattr(journal, 'RENDER_POOL_THRESHOLD', 0)
+    monkeypatch.setattr(journal, 'RENDER_TIMEOUT', 0)
+    before = journal.render_fallbacks['timeout']
+    html = journal.render_markdown('# <b>title</b>')
+    assert html == ('<pre class="render-fallback">'
+                    '# &lt;b&gt;title&lt;/b&gt;</pre>')
+    assert journal.render_fallbacks['timeout'] == before + 1
+
+
+def test_render_timeout_spares_other_workers(monkeypatch):
+    monkeypatch.setattr(journal, 'RENDER_POOL_THRESHOLD', 0)
+    monkeypatch.setattr(journal, 'RENDER_TIMEOUT', 0)
+    idle = [journal._RenderWorker(), journal._RenderWorker()]
+    monkeypatch.setattr(journal, '_idle_render_workers', list(idle))
+    try:
+        journal.render_markdown('# times out')
+        # The timed out render took the last idle worker and killed it
+        assert journal._idle_render_workers == idle[:1]
+        assert idle[0].process.is_alive()
+        assert not idle[1].process.is_alive()
+    finally:
+        for worker in idle:
+            worker.stop()
+
+
+def test_render_dead_worker_falls_back(monkeypatch):
+    monkeypatch.setattr(journal, 'RENDER_POOL_THRESHOLD', 0)
+    monkeypatch.setattr(journal, 'RENDER_TIMEOUT', 30)
+    worker = journal._RenderWorker()
+    worker.process.terminate()
+    worker.process.join()
+    monkeypatch.setattr(journal, '_idle_render_workers', [worker])
+    before = journal.render_fallbacks['error']
+    html = journal.render_markdown('# A large title')
+    assert 'render-fallback' in html
+    assert journal.render_fallbacks['error'] == before + 1
+    assert journal._idle_render_workers == []
+
+
+def test_render_busy_falls_back(monkeypatch):
+    import threading
+    monkeypatch.setattr(journal, 'RENDER_POOL_THRESHOLD', 0)
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(journal, '_render_slots', slots)
+    before = journal.render_fallbacks['busy']
+    html = journal.render_markdown('# A large title')
+    assert 'render-fallback' in html
+    assert journal.render_fallbacks['busy'] == before + 1
+
+
+def test_render_oversize_falls_back(monkeypatch):
+    monkeypatch.setattr(journal, 'RENDER_MAX_SIZE', 5)
+    before = journal.render_fallbacks['oversize']
+    html = journal.render_markdown('# A large title')
+    assert 'render-fallback' in html
+    assert journal.render_fallbacks['oversize'] == before + 1
+
+
+def test_archive_huge_year(app):
+    app.get('/archive/99999999999999999999/1', status=404)
+
+
+def test_month_count_increment_existing_bucket(db_session, connection):
+    created = datetime.datetime(2015, 7, 1)
+    journal.MonthCount.increment(created, connection)
+    journal.MonthCount.increment(created, connection)
+    table = journal.MonthCount.__table__
+    count = connection.execute(sa.select([table.c.count]).where(sa.and_(
+        table.c.year == 2015, table.c.month == 7))).scalar()
+    assert count == 2
+
+
+def test_tag_with_slash_is_routable(app, db_session):
+    journal.Entry.write(title="CI", body_text="Text", tags=['CI/CD'],
+                        session=db_session)
+    db_session.flush()
+    assert [tag.name for tag in journal.Tag.cloud()] == ['ci-cd']
+    assert 'href="/tag/ci-cd"' in app.get('/').body
+    assert 'CI' in app.get('/tag/ci-cd').body
+
+
+def test_slow_query_log_relative_path(tmpdir, monkeypatch):
+    monkeypatch.setattr(journal, 'SLOW_QUERY_THRESHOLD', None)
+    monkeypatch.chdir(tmpdir)
+    before = list(journal.slow_query_log.handlers)
+    try:
+        journal.watch_slow_queries(1, log_path='slow.log')
+        journal.watch_slow_queries(1, log_path='slow.log')
+        added = [h for h in journal.slow_query_log.handlers
+                 if h not in before]
+        assert len(added) == 1
+    finally:
+        for handler in journal.slow_query_log.handlers[:]:
+            if handler not in before:
+                journal.slow_query_log.removeHandler(handler)
+                handler.close()
+
+
+def test_slow_query_log_has_handler(monkeypatch):
+    import logging
+    monkeypatch.setattr(journal, 'SLOW_QUERY_THRESHOLD', None)
+    monkeypatch.setattr(journal.slow_query_log, 'handlers', [])
+    monkeypatch.setattr(logging.getLogger(), 'handlers', [])
+    journal.watch_slow_queries(1)
+    assert len(journal.slow_query_log.handlers) == 1
+    assert journal.slow_query_log.isEnabledFor(logging.WARNING)
+
+
+@pytest.fixture()
+def committed_entry(request):
+    # Pool workers use their own connections, so they can't see the
+    # fixture's uncommitted transaction; commit this row for real
+    engine = sa.create_engine(os.environ['DATABASE_URL'])
+    table = journal.Entry.__table__
+    with engine.begin() as conn:
+        entry_id = conn.execute(table.insert().values(
+            title='Committed', body_text='Rendered by a worker',
+            created=datetime.datetime.utcnow())).inserted_primary_key[0]
+
+    def cleanup():
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.id == entry_id))
+        engine.dispose()
+
+    request.addfinalizer(cleanup)
+    return entry_id
+
+
+def test_export_site_process_pool(app, committed_entry, tmpdir):
+    rendered = journal.export_site(
+        str(tmpdir), processes=1, database_url=os.environ['DATABASE_URL'])
+    assert rendered == [committed_entry]
+    detail = tmpdir.join('detail', str(committed_entry), 'index.html')
+    assert 'Rendered by a worker' in detail.read()